@@ -1,34 +1,99 @@
-import os
+import io
+import json
 import base64
+import asyncio
+import uuid
+import hashlib
+import threading
+from contextlib import closing, suppress
+import httpx
 import streamlit as st
 from PIL import Image
-from typing import Annotated
+from typing import Annotated, Literal
 from typing_extensions import TypedDict
+from pydantic import BaseModel, ValidationError
 
 # --- LangChain & Tools ---
+from langchain_core.messages import HumanMessage, ToolMessage
+from langchain_core.tools import ToolException
 from langchain_openai import ChatOpenAI
 from langchain_community.tools import DuckDuckGoSearchRun  # For DuckDuckGo search integration
+from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
 
 # --- LangGraph ---
-from langgraph.graph import StateGraph
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, StateGraph
 from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.prebuilt import tools_condition
+
+
+# Maximum number of finished analyses kept per session
+MAX_CACHED_ANALYSES = 32
+# Number of streamed chunks between redraws of the draft analysis
+DRAFT_REFRESH_CHUNKS = 16
+# Maximum number of images analyzed at the same time, to stay under OpenAI rate limits
+MAX_CONCURRENT_ANALYSES = 8
+# Seconds an idle OpenAI connection stays pooled (httpx defaults to 5 s, shorter than a user's reaction time)
+KEEPALIVE_SECONDS = 60
+# Number of invalid MedicalReport tool calls tolerated before the run fails
+MAX_REPORT_ATTEMPTS = 3
+# Output cap for every model call; any chatbot turn may file a full MedicalReport, which fails validation if truncated
+REPORT_MAX_TOKENS = 2048
 
 
 # ------------------------------------------------------------
-# 1) Define the LangGraph State
+# 1) Define the report schema and the LangGraph State
 # ------------------------------------------------------------
+class Finding(BaseModel):
+    """A single observation on the image."""
+    observation: str
+    location: str
+    severity: Literal["Normal", "Mild", "Moderate", "Severe"]
+
+
+class Diagnosis(BaseModel):
+    """A candidate diagnosis and the imaging evidence supporting it."""
+    condition: str
+    confidence: Literal["Low", "Medium", "High"]
+    evidence: str
+
+
+class Assessment(BaseModel):
+    """Primary diagnosis, ranked differentials and urgent findings."""
+    primary_diagnosis: Diagnosis
+    differential_diagnoses: list[Diagnosis]
+    critical_findings: list[str]
+
+
+class Reference(BaseModel):
+    """A supporting source found during research."""
+    title: str
+    url: str
+    summary: str
+
+
+class MedicalReport(BaseModel):
+    """Structured radiology report returned by the agent."""
+    image_type: str
+    findings: list[Finding]
+    assessment: Assessment
+    patient_explanation: str
+    references: list[Reference]
+
+
 class State(TypedDict):
     messages: Annotated[list, add_messages]
-
-# Create a StateGraph
-graph_builder = StateGraph(State)
+    report: MedicalReport
+    report_attempts: int
 
 # ------------------------------------------------------------
 # 2) Check for required session variable: OPENAI_API_KEY
 # ------------------------------------------------------------
 if "OPENAI_API_KEY" not in st.session_state:
     st.session_state.OPENAI_API_KEY = None
+if "TAVILY_API_KEY" not in st.session_state:
+    st.session_state.TAVILY_API_KEY = None
 
 # ------------------------------------------------------------
 # 3) Sidebar: Input field for OpenAI API Key
@@ -55,6 +120,17 @@ with st.sidebar:
             st.session_state.OPENAI_API_KEY = None
             st.rerun()
 
+    tavily_api_key = st.text_input(
+        "Tavily API Key (optional):",
+        type="password",
+        value=st.session_state.TAVILY_API_KEY or "",
+    )
+    st.caption(
+        "With a [Tavily](https://app.tavily.com) key, research uses its JSON search API "
+        "instead of scraping DuckDuckGo 🔎"
+    )
+    st.session_state.TAVILY_API_KEY = tavily_api_key or None
+
     st.info(
         "This tool provides AI-powered analysis of medical imaging data using "
         "advanced computer vision and radiological expertise."
@@ -68,179 +144,703 @@ with st.sidebar:
 # ------------------------------------------------------------
 # 4) Initialize LangGraph Components
 # ------------------------------------------------------------
-medical_agent = None
-if st.session_state.OPENAI_API_KEY:
-    llm = ChatOpenAI(
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Start a single background event loop shared by every agent run in this process.
+
+    The cached agent keeps its async HTTP clients across reruns, and their pooled
+    connections are bound to the loop that opened them, so all runs must share it.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def iter_async(agen):
+    """Iterate an async generator on the background loop from the Streamlit script thread.
+
+    Closing this iterator (e.g. when a rerun stops the script mid-stream) also closes agen.
+    """
+    loop = get_event_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+@st.cache_resource(show_spinner=False)
+def get_active_threads():
+    """Thread ids with a run in progress in this process; only touched on the background loop."""
+    return set()
+
+
+async def stream_analyses(agent, runs, active_threads):
+    """Run the agent on several (input, config) pairs concurrently, yielding (index, mode, payload).
+
+    Failures are yielded as (index, "error", exception) so one image cannot abort the others.
+    Thread ids are kept in active_threads while their run is going, so pruning skips them.
+    """
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+    async def run(index, state, config):
+        thread_id = config["configurable"]["thread_id"]
+        active_threads.add(thread_id)
+        try:
+            async with semaphore:
+                async for mode, payload in agent.astream(state, config, stream_mode=["messages", "values"]):
+                    queue.put_nowait((index, mode, payload))
+        except Exception as e:
+            queue.put_nowait((index, "error", e))
+        finally:
+            active_threads.discard(thread_id)
+            queue.put_nowait((index, "done", None))
+
+    tasks = asyncio.gather(*(run(index, state, config) for index, (state, config) in enumerate(runs)))
+    try:
+        remaining = len(runs)
+        while remaining:
+            index, mode, payload = await queue.get()
+            if mode == "done":
+                remaining -= 1
+            else:
+                yield index, mode, payload
+        await tasks
+    finally:
+        # Stop runs nobody is reading any more; their checkpoints let a later click resume them
+        tasks.cancel()
+        with suppress(asyncio.CancelledError):
+            await tasks
+
+
+def forget_threads(checkpointer: MemorySaver, finished, active_threads):
+    """Drop the checkpoints of finished threads, and of the oldest idle ones beyond MAX_CACHED_ANALYSES.
+
+    Runs on the background loop, which is the only place checkpoints are written.
+    Threads in active_threads are never touched.
+    """
+    def forget():
+        # get_state() on an unseen thread leaves an empty entry behind; those hold no checkpoints
+        idle, empty = [], []
+        for thread_id, namespaces in list(checkpointer.storage.items()):
+            if thread_id not in active_threads:
+                (idle if any(namespaces.values()) else empty).append(thread_id)
+        stale = idle[:-MAX_CACHED_ANALYSES]
+        finished_idle = [thread_id for thread_id in finished if thread_id not in active_threads]
+        for thread_id in {*finished_idle, *stale, *empty}:
+            checkpointer.storage.pop(thread_id, None)
+            # Newer MemorySaver releases also keep channel values in a separate "blobs" dict
+            for store in (checkpointer.writes, getattr(checkpointer, "blobs", {})):
+                for key in [key for key in store if key[0] == thread_id]:
+                    del store[key]
+
+    get_event_loop().call_soon_threadsafe(forget)
+
+
+@st.cache_resource(show_spinner=False)
+def build_llm(api_key: str):
+    """Create the chat model once per API key so its HTTP connection pool is reused."""
+    return ChatOpenAI(
         model="gpt-4o-mini",
         #model="gpt-4o",
-        temperature=0.7,
-        openai_api_key=st.session_state.OPENAI_API_KEY,
+        temperature=0.3,
+        max_tokens=REPORT_MAX_TOKENS,
+        streaming=True,
+        openai_api_key=api_key,
+        http_async_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=KEEPALIVE_SECONDS)
+        ),
     )
 
-    ddg_tool = DuckDuckGoSearchRun()  # Initialize DuckDuckGo search tool
+
+def warm_connection(api_key: str):
+    """Open the OpenAI connection in the background with a cheap GET /v1/models.
+
+    The connection stays pooled for KEEPALIVE_SECONDS, unless OpenAI closes it earlier.
+    """
+    client = build_llm(api_key).root_async_client
+
+    async def ping():
+        await client.models.list()
+
+    asyncio.run_coroutine_threadsafe(ping(), get_event_loop())
+
+
+@st.cache_resource(show_spinner=False)
+def build_agent(api_key: str, tavily_api_key: str | None = None):
+    """Build and compile the medical agent graph once per API key."""
+    llm = build_llm(api_key)
+
+    if tavily_api_key:
+        # Tavily has a real JSON API with native async; keep the DuckDuckGo tool name so the prompt still binds
+        ddg_tool = TavilySearchResults(
+            name="duckduckgo_search",
+            max_results=3,
+            search_depth="basic",
+            api_wrapper=TavilySearchAPIWrapper(tavily_api_key=tavily_api_key),
+        )
+    else:
+        ddg_tool = DuckDuckGoSearchRun()  # Initialize DuckDuckGo search tool
     tools = [ddg_tool]
-    llm_with_tools = llm.bind_tools(tools)
+    # MedicalReport is bound as a tool too: the final chatbot turn files the report as its arguments
+    llm_with_tools = llm.bind_tools(tools + [MedicalReport])
+    llm_with_report = llm.bind_tools([MedicalReport], tool_choice="MedicalReport")
 
-    # Define the chatbot node
-    def chatbot(state: State):
-        response = llm_with_tools.invoke(state["messages"])
+    # Define the chatbot node (async, so the OpenAI round-trip doesn't pin the script thread)
+    async def chatbot(state: State):
+        response = await llm_with_tools.ainvoke(state["messages"])
         #st.write("Debugging: Tool invocation response", response)
-        return {"messages": [response]}
+        messages = [response]
+        if not response.tool_calls:
+            # The model answered in prose instead of filing the report; have it file one now
+            response = await llm_with_report.ainvoke(state["messages"] + messages)
+            messages.append(response)
+        for tool_call in response.tool_calls:
+            if tool_call["name"] != "MedicalReport":
+                continue
+            try:
+                return {"messages": messages, "report": MedicalReport.model_validate(tool_call["args"])}
+            except ValidationError as e:
+                attempts = state.get("report_attempts", 0) + 1
+                if attempts >= MAX_REPORT_ATTEMPTS:
+                    raise
+                # Answer every call of this turn, so the model sees what was wrong and can resubmit
+                messages += [
+                    ToolMessage(
+                        content=(
+                            f"Error: {e}\n Please fix your mistakes and call MedicalReport again."
+                            if tc["id"] == tool_call["id"]
+                            else "Not run: the MedicalReport call in this turn was invalid."
+                        ),
+                        name=tc["name"],
+                        tool_call_id=tc["id"],
+                        status="error",
+                    )
+                    for tc in response.tool_calls
+                ]
+                return {"messages": messages, "report_attempts": attempts}
+        return {"messages": messages}
+
+    # Stop once a report has been filed, retry an invalid report, otherwise run the requested searches
+    def route_chatbot(state: State):
+        if state.get("report") is not None:
+            return END
+        if state["messages"][-1].type == "tool":
+            return "chatbot"
+        return tools_condition(state)
+
+    # Define the tool node: run every tool call of the last AI message concurrently
+    tools_by_name = {tool.name: tool for tool in tools}
+
+    async def run_tool(tool_call):
+        tool = tools_by_name.get(tool_call["name"])
+        if tool is None:
+            # Same reply as the prebuilt ToolNode, so the model can correct itself
+            return ToolMessage(
+                content=(
+                    f"Error: {tool_call['name']} is not a valid tool, "
+                    f"try one of [{', '.join(tools_by_name)}]."
+                ),
+                name=tool_call["name"],
+                tool_call_id=tool_call["id"],
+                status="error",
+            )
+        result = await tool.ainvoke(tool_call["args"])
+        if isinstance(tool, TavilySearchResults) and isinstance(result, str):
+            # TavilySearchResults swallows API errors and returns their repr; successes are a list
+            raise ToolException(result)
+        # Tavily returns a list of dicts; keep it as JSON rather than a Python repr
+        content = result if isinstance(result, str) else json.dumps(result)
+        return ToolMessage(content=content, name=tool_call["name"], tool_call_id=tool_call["id"])
+
+    async def parallel_tool_node(state: State):
+        tool_calls = state["messages"][-1].tool_calls
+        results = await asyncio.gather(*(run_tool(tc) for tc in tool_calls), return_exceptions=True)
+        # A failed search fails the node, so the checkpoint stays before "tools" and Retry redoes only the searches
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return {"messages": results}
+
+    # Define the compaction node: once the model has written its findings, drop the image from the
+    # history so later chatbot turns don't re-send the Base64 payload
+    def has_text(message):
+        if isinstance(message.content, str):
+            return bool(message.content.strip())
+        return any(
+            isinstance(block, dict) and block.get("type") == "text" and block.get("text", "").strip()
+            for block in message.content
+        )
 
-    # Add the chatbot and tool nodes to the graph
+    async def compact_history(state: State):
+        first = state["messages"][0]
+        if isinstance(first.content, str):
+            return {}
+        # Turns that only issued tool calls describe nothing yet; keep the image until the report is filed
+        if not any(message.type == "ai" and has_text(message) for message in state["messages"][1:]):
+            return {}
+        text = "".join(block["text"] for block in first.content if block.get("type") == "text")
+        return {
+            "messages": [
+                HumanMessage(
+                    content=text + "\nImage already analyzed; your findings are in your replies that follow. Proceed to research.",
+                    id=first.id,
+                )
+            ]
+        }
+
+    # Add the chatbot, tool and compaction nodes to the graph
+    graph_builder = StateGraph(State)
     graph_builder.add_node("chatbot", chatbot)
-    tool_node = ToolNode(tools=tools)
-    graph_builder.add_node("tools", tool_node)
+    graph_builder.add_node("tools", parallel_tool_node)
+    graph_builder.add_node("compact", compact_history)
 
     # Define edges between nodes
-    graph_builder.add_conditional_edges("chatbot", tools_condition)
-    graph_builder.add_edge("tools", "chatbot")
+    graph_builder.add_conditional_edges("chatbot", route_chatbot, {"chatbot": "chatbot", "tools": "tools", END: END})
+    graph_builder.add_edge("tools", "compact")
+    graph_builder.add_edge("compact", "chatbot")
     graph_builder.set_entry_point("chatbot")
 
-    medical_agent = graph_builder.compile()
+    # Checkpoint every step per image so a failed run resumes instead of redoing the vision call
+    return graph_builder.compile(checkpointer=MemorySaver())
+
+
+medical_agent = None
+if st.session_state.OPENAI_API_KEY:
+    medical_agent = build_agent(st.session_state.OPENAI_API_KEY, st.session_state.TAVILY_API_KEY)
 else:
     st.warning("Please configure your OpenAI API Key in the sidebar to continue.")
 
 # ------------------------------------------------------------
 # 5) Define the Prompt/Query
 # ------------------------------------------------------------
-query = """
-You are a highly skilled university professor of radiology and medical imaging with extensive knowledge in diagnostic imaging. 
-Explain this image to your students as accurately as possible and structure your response as follows (always only text):
-
-### 1. Image Type & Region
-- Specify imaging modality (X-ray/MRI/CT/Ultrasound/etc.)
-- Identify the patient's anatomical region and positioning
-- Comment on image quality and technical adequacy
-
-### 2. Key Findings
-- List primary observations systematically
-- Note any abnormalities in the patient's imaging with precise descriptions
-- Include measurements and densities where relevant
-- Describe location, size, shape, and characteristics
-- Rate severity: Normal/Mild/Moderate/Severe
-
-### 3. Diagnostic Assessment
-- Provide primary diagnosis with confidence level
-- List differential diagnoses in order of likelihood
-- Support each diagnosis with observed evidence from the patient's imaging
-- Note any critical or urgent findings
-
-### 4. Patient-Friendly Explanation
-- Explain the findings in simple, clear language that the patient can understand
-- Avoid medical jargon or provide clear definitions
-- Include visual analogies if helpful
-- Address common patient concerns related to these findings
-
-### 5. Research Context
-IMPORTANT: Use the DuckDuckGo search tool to:
-- Find recent medical literature about similar cases
-- Search for standard treatment protocols
-- Provide a list of relevant medical links
-- Research any relevant technological advances
-- Include 2-3 key references to support your analysis
-
-Format your response using clear markdown headers and bullet points. Be concise yet thorough.
+analysis_prompt = """
+You are a highly skilled university professor of radiology and medical imaging with extensive knowledge in diagnostic imaging.
+Explain this image to your students as accurately as possible. Be concise; your final answer is a structured report with:
+1. Image type & region: modality, anatomical region, positioning, image quality.
+2. Key findings: each observation with location, size/density where relevant, and severity (Normal/Mild/Moderate/Severe).
+3. Diagnostic assessment: primary diagnosis with confidence, ranked differentials with supporting evidence, critical or urgent findings.
+4. Patient-friendly explanation in plain language, without jargon.
+5. Research context: 2-3 key references with links.
+"""
+
+query = analysis_prompt + """
+IMPORTANT: Use the DuckDuckGo search tool to find recent literature on similar cases, standard treatment protocols
+and relevant technological advances.
+Issue all independent DuckDuckGo queries in a single assistant turn so they run in parallel,
+and write out your image findings in that same turn: once you have described them in text,
+the image is removed from the conversation.
+When your research is done, call MedicalReport with the final report instead of writing it out as text.
+"""
+
+# The Batch API cannot run tools, so overnight requests cite references without searching
+batch_query = analysis_prompt + """
+Web search is not available: only cite well-established references you are confident exist.
 """
 
 # ------------------------------------------------------------
 # 6) Build the Streamlit UI
 # ------------------------------------------------------------
+def render_report(report: MedicalReport):
+    """Render a MedicalReport as the five analysis sections."""
+    st.markdown(f"### 1. Image Type & Region\n{report.image_type}")
+
+    st.markdown("### 2. Key Findings")
+    st.markdown("\n".join(
+        f"- **{finding.severity}** — {finding.observation} ({finding.location})"
+        for finding in report.findings
+    ))
+
+    st.markdown("### 3. Diagnostic Assessment")
+    primary = report.assessment.primary_diagnosis
+    st.markdown(
+        f"**Primary diagnosis:** {primary.condition} ({primary.confidence} confidence)  \n{primary.evidence}"
+    )
+    if report.assessment.differential_diagnoses:
+        st.markdown("**Differential diagnoses:**\n" + "\n".join(
+            f"1. {diagnosis.condition} ({diagnosis.confidence}) — {diagnosis.evidence}"
+            for diagnosis in report.assessment.differential_diagnoses
+        ))
+    for critical_finding in report.assessment.critical_findings:
+        st.error(f"⚠️ {critical_finding}")
+
+    st.markdown(f"### 4. Patient-Friendly Explanation\n{report.patient_explanation}")
+
+    st.markdown("### 5. Research Context")
+    st.markdown("\n".join(
+        f"- [{reference.title}]({reference.url}) — {reference.summary}"
+        for reference in report.references
+    ))
+
+
+def to_rgb(image):
+    """Convert an upload to 8-bit RGB for JPEG encoding without clipping high bit depths or alpha."""
+    if image.mode in ("I;16", "I;16L", "I;16B", "I;16N", "I", "F"):
+        # 16-bit or float grayscale (e.g. DICOM-derived PNGs): stretch the used range onto 0-255
+        image = image.convert("F") if image.mode == "F" else image.convert("I").convert("F")
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 0.0
+        image = image.point(lambda value: (value - low) * scale).convert("L")
+    elif image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        # Flatten transparency onto black instead of dropping alpha and exposing hidden pixels
+        image = image.convert("RGBA")
+        image = Image.alpha_composite(Image.new("RGBA", image.size, (0, 0, 0, 255)), image)
+    return image.convert("RGB")
+
+
+def prepare_image(uploaded_file):
+    """Return the decoded image, a content hash of the upload and its Base64 JPEG payload."""
+    raw = uploaded_file.getvalue()
+    image = Image.open(io.BytesIO(raw))
+    image_hash = hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    # Downscale and JPEG-encode once per upload: with detail "low" the vision
+    # API only sees a 512x512 tile, so full-resolution bytes are wasted
+    encoded_key = f"enc_{uploaded_file.file_id}"
+    if encoded_key not in st.session_state:
+        preview = to_rgb(image)
+        preview.thumbnail((768, 768), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        preview.save(buf, format="JPEG", quality=85, optimize=True)
+        st.session_state[encoded_key] = base64.b64encode(buf.getvalue()).decode()
+    return image, image_hash, st.session_state[encoded_key]
+
+
+def image_message(text: str, encoded_image: str):
+    """Build the user message that pairs the prompt with one encoded image."""
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": text},
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{encoded_image}",
+                    "detail": "low"
+                }
+            }
+        ]
+    }
+
+
+def build_state(encoded_image: str):
+    """Prepare the initial graph state for one encoded image."""
+    return {"messages": [image_message(query, encoded_image)]}
+
+
+def request_retry():
+    """Ask the next rerun to resume the analyses that failed."""
+    st.session_state.retry_analysis = True
+
+
+def submit_batch(api_key: str, images):
+    """Submit (custom_id, encoded_image) pairs to the OpenAI Batch API and return the batch."""
+    llm = build_llm(api_key)
+    requests = [
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": llm.model_name,
+                "temperature": llm.temperature,
+                "max_tokens": REPORT_MAX_TOKENS,
+                "messages": [image_message(batch_query, encoded_image)],
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {"name": "MedicalReport", "schema": MedicalReport.model_json_schema()},
+                },
+            },
+        }
+        for custom_id, encoded_image in images
+    ]
+    jsonl = io.BytesIO("\n".join(json.dumps(request) for request in requests).encode())
+    batch_file = llm.root_client.files.create(file=("medical_images.jsonl", jsonl), purpose="batch")
+    return llm.root_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+
+def fetch_batch_reports(api_key: str, batch_id: str):
+    """Poll a batch and, once it has completed, parse its output into MedicalReports keyed by custom_id.
+
+    Requests that failed or returned an invalid report are collected as (custom_id, reason) pairs,
+    with custom_id None for lines that could not be parsed, so one bad reply doesn't discard the rest.
+    """
+    client = build_llm(api_key).root_client
+    batch = client.batches.retrieve(batch_id)
+    reports, failures = {}, []
+    if batch.status != "completed":
+        return batch, reports, failures
+
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines.extend(client.files.content(file_id).text.splitlines())
+    for line in lines:
+        custom_id = None
+        try:
+            result = json.loads(line)
+            custom_id = result["custom_id"]
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                raise ValueError(result.get("error") or f"HTTP {response.get('status_code')}")
+            content = response["body"]["choices"][0]["message"]["content"]
+            reports[custom_id] = MedicalReport.model_validate_json(content)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            failures.append((custom_id, str(e)))
+    return batch, reports, failures
+
+
 st.title("🏥 Medical Imaging Diagnosis Agent")
-st.write("Upload a medical image for professional analysis")
+st.write("Upload one or more medical images for professional analysis")
 
 upload_container = st.container()
-image_container = st.container()
-analysis_container = st.container()
 
 with upload_container:
-    uploaded_file = st.file_uploader(
-        "Upload Medical Image",
+    uploaded_files = st.file_uploader(
+        "Upload Medical Images",
         type=["jpg", "jpeg", "png"],
-        help="Supported formats: JPG, JPEG, PNG"
+        accept_multiple_files=True,
+        help="Supported formats: JPG, JPEG, PNG. Multiple images are analyzed concurrently."
     )
 
-if uploaded_file is not None:
-    with image_container:
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            image = Image.open(uploaded_file)
-            image_path = "temp_medical_image.png"
-            image.save(image_path)
-
-            # Encode the image to Base64
-            with open(image_path, "rb") as img_file:
-                encoded_image = base64.b64encode(img_file.read()).decode()
-
-            # Display the image
-            st.image(
-                image,
-                caption="Uploaded Medical Image",
-                use_container_width=True
-            )
+if uploaded_files:
+    # Hide the TCP/TLS handshake behind the time the user takes to click "Analyze"
+    warm_key = (st.session_state.OPENAI_API_KEY, tuple(uploaded_file.file_id for uploaded_file in uploaded_files))
+    if medical_agent and st.session_state.get("warmed") != warm_key:
+        st.session_state.warmed = warm_key
+        warm_connection(st.session_state.OPENAI_API_KEY)
 
-            analyze_button = st.button(
-                "🔍 Analyze Image",
-                type="primary",
-                use_container_width=True
-            )
+    prepared = [prepare_image(uploaded_file) for uploaded_file in uploaded_files]
 
-    with analysis_container:
-        if analyze_button:
-            with st.spinner("🔄 Analyzing image... Please wait."):
-                try:
-                    if medical_agent:
-                        # Prepare the state for the graph
-                        state = {
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {"type": "text", "text": query},
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": f"data:image/png;base64,{encoded_image}",
-                                                "detail": "low"
-                                            }
-                                        }
-                                    ]
-                                }
-                            ]
-                        }
-
-                        # Invoke the medical agent
-                        result_state = medical_agent.invoke(state)
-
-                        # Debugging: Log the full response structure
-                        #st.write("Debugging: Full response from medical agent", result_state)
-
-                        # Extract the response content
-                        combined_response = ""
-                        for message in result_state["messages"]:
-                            # Handle AI response
-                            if hasattr(message, "type") and message.type == "ai":
-                                if hasattr(message, "content") and message.content:
-                                    combined_response += message.content
-                            # Handle tool responses
-                            elif hasattr(message, "type") and message.type == "tool_call":
-                                if hasattr(message, "content") and message.content:
-                                    combined_response += f"\n\n### Tool Result:\n{message.content}"
-
-                        # Display the combined response
-                        if combined_response.strip():
+    overnight = st.toggle(
+        "🌙 Overnight batch (50% cheaper)",
+        help="Submit through the OpenAI Batch API. Results arrive within 24 hours and skip the web research step."
+    )
+    analyze_button = st.button(
+        "🔍 Analyze Images" if len(uploaded_files) > 1 else "🔍 Analyze Image",
+        type="primary",
+        use_container_width=True
+    )
+    run_analysis = analyze_button or st.session_state.pop("retry_analysis", False)
+
+    # One tab per image, each with a placeholder for its analysis
+    tabs = st.tabs([uploaded_file.name for uploaded_file in uploaded_files])
+    placeholders = []
+    for tab, (image, _, _) in zip(tabs, prepared):
+        with tab:
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                # Display the image
+                st.image(
+                    image,
+                    caption="Uploaded Medical Image",
+                    use_container_width=True
+                )
+            placeholders.append(st.container())
+
+    if analyze_button and overnight:
+        # custom_id must be unique per batch, so identical uploads share one request;
+        # images that already have a report are not billed again
+        analysis_cache = st.session_state.get("analysis_cache", {})
+        unique_images = {}
+        for uploaded_file, (_, image_hash, encoded_image) in zip(uploaded_files, prepared):
+            if image_hash not in analysis_cache:
+                unique_images.setdefault(image_hash, (encoded_image, []))[1].append(uploaded_file.name)
+        try:
+            if not st.session_state.OPENAI_API_KEY:
+                st.warning("No agent is configured. Please ensure you have provided your OpenAI key.")
+            elif not unique_images:
+                st.info("All of these images already have a report. Turn off overnight mode to view them.")
+            else:
+                batch = submit_batch(
+                    st.session_state.OPENAI_API_KEY,
+                    [(image_hash, encoded_image) for image_hash, (encoded_image, _) in unique_images.items()],
+                )
+                st.session_state.batch = {
+                    "id": batch.id,
+                    "names": {image_hash: ", ".join(names) for image_hash, (_, names) in unique_images.items()},
+                }
+                st.success(f"Batch {batch.id} submitted. Check its status below.")
+        except Exception as e:
+            st.error(f"Batch submission error: {e}")
+    elif run_analysis:
+        retry_needed = False
+        with st.spinner("🔄 Analyzing images... Please wait."):
+            try:
+                if medical_agent:
+                    # Reuse previous analyses of the same image bytes instead of re-running the agent
+                    analysis_cache = st.session_state.setdefault("analysis_cache", {})
+                    results = {
+                        index: analysis_cache[image_hash]
+                        for index, (_, image_hash, _) in enumerate(prepared)
+                        if image_hash in analysis_cache
+                    }
+                    pending = [index for index in range(len(prepared)) if index not in results]
+
+                    outputs, drafts, final_states, errors = {}, {}, {}, {}
+                    for index in range(len(prepared)):
+                        with placeholders[index]:
                             st.markdown("### 📋 Analysis Results")
-                            st.markdown(combined_response)
+                            outputs[index] = st.empty()
+
+                    # The same image uploaded twice is analyzed once and shown in both tabs
+                    indices_by_hash = {}
+                    for index in pending:
+                        indices_by_hash.setdefault(prepared[index][1], []).append(index)
+
+                    # Each image is a checkpointed thread, scoped to this session because the agent is shared:
+                    # finished threads are read back, failed ones resume
+                    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+                    thread_ids = {image_hash: f"{session_id}:{image_hash}" for image_hash in indices_by_hash}
+                    active_threads = get_active_threads()
+                    to_run, runs = [], []
+                    for image_hash, indices in indices_by_hash.items():
+                        config = {"configurable": {"thread_id": thread_ids[image_hash]}}
+                        snapshot = medical_agent.get_state(config)
+                        if snapshot.next:
+                            to_run.append(image_hash)
+                            runs.append((None, config))
+                        elif snapshot.values.get("report") is not None:
+                            final_states[image_hash] = snapshot.values
                         else:
-                            st.error("AI response content is missing or improperly formatted.")
-                    else:
-                        st.warning("No agent is configured. Please ensure you have provided your OpenAI key.")
-                except Exception as e:
-                    st.error(f"Analysis error: {e}")
-                finally:
-                    # Clean up the temporary file
-                    if os.path.exists(image_path):
-                        os.remove(image_path)
+                            to_run.append(image_hash)
+                            runs.append((build_state(prepared[indices[0]][2]), config))
+
+                    # Stream every running image's draft into its tab, then swap in the structured reports.
+                    # Turns that only make tool calls have no text, so show what the model is doing instead
+                    statuses = {}
+
+                    def show_draft(image_hash):
+                        text = "".join(drafts.get(image_hash, []))
+                        if image_hash in statuses:
+                            text += f"\n\n*{statuses[image_hash]}*"
+                        for index in indices_by_hash[image_hash]:
+                            outputs[index].markdown(text)
+
+                    if runs:
+                        for image_hash in to_run:
+                            statuses[image_hash] = "🩻 Reading the image…"
+                            show_draft(image_hash)
+                        with closing(iter_async(stream_analyses(medical_agent, runs, active_threads))) as events:
+                            for position, mode, payload in events:
+                                image_hash = to_run[position]
+                                if mode == "values":
+                                    final_states[image_hash] = payload
+                                elif mode == "error":
+                                    errors[image_hash] = payload
+                                else:
+                                    chunk, meta = payload
+                                    if meta.get("langgraph_node") != "chatbot":
+                                        continue
+                                    if chunk.content:
+                                        draft = drafts.setdefault(image_hash, [])
+                                        draft.append(chunk.content)
+                                        if len(draft) % DRAFT_REFRESH_CHUNKS == 0:
+                                            show_draft(image_hash)
+                                    for tool_call_chunk in getattr(chunk, "tool_call_chunks", []):
+                                        if tool_call_chunk.get("name"):
+                                            statuses[image_hash] = (
+                                                "📝 Writing the structured report…"
+                                                if tool_call_chunk["name"] == "MedicalReport"
+                                                else "🔎 Searching the literature…"
+                                            )
+                                            show_draft(image_hash)
+                        statuses.clear()
+                        for image_hash in to_run:
+                            show_draft(image_hash)
+
+                    for image_hash, indices in indices_by_hash.items():
+                        final_state = final_states.get(image_hash, {})
+                        report = final_state.get("report")
+                        tool_results = [
+                            message.content
+                            for message in final_state.get("messages", [])
+                            if message.type == "tool" and message.status != "error" and message.content
+                        ]
+                        for index in indices:
+                            results[index] = (report, tool_results)
+                        if report is not None:
+                            analysis_cache[image_hash] = (report, tool_results)
+                    # Finished reports live in the analysis cache; their checkpoints (with the image) can go
+                    forget_threads(
+                        medical_agent.checkpointer,
+                        [thread_ids[image_hash] for image_hash in indices_by_hash if image_hash in analysis_cache],
+                        active_threads,
+                    )
+                    while len(analysis_cache) > MAX_CACHED_ANALYSES:
+                        analysis_cache.pop(next(iter(analysis_cache)))
+
+                    for index, (report, tool_results) in sorted(results.items()):
+                        with placeholders[index]:
+                            if report is not None:
+                                with outputs[index].container():
+                                    render_report(report)
+                            elif prepared[index][1] in errors:
+                                st.error(f"Analysis error: {errors[prepared[index][1]]}")
+                            else:
+                                st.error("AI response content is missing or improperly formatted.")
+
+                            if tool_results:
+                                with st.expander("🔎 Research Tool Results"):
+                                    for tool_result in tool_results:
+                                        st.markdown(tool_result)
+                    retry_needed = bool(errors)
+                else:
+                    st.warning("No agent is configured. Please ensure you have provided your OpenAI key.")
+            except Exception as e:
+                st.error(f"Analysis error: {e}")
+                retry_needed = True
+
+        if retry_needed:
+            st.button(
+                "🔁 Retry",
+                on_click=request_retry,
+                help="Resume the failed analyses from their last completed step"
+            )
 
 else:
     st.info("👆 Please upload a medical image to begin analysis")
+
+# ------------------------------------------------------------
+# 7) Overnight batch status
+# ------------------------------------------------------------
+if st.session_state.get("batch") and st.session_state.OPENAI_API_KEY:
+    st.markdown("### 🌙 Overnight Batch")
+    batch_info = st.session_state.batch
+    if st.button("🔄 Check status"):
+        try:
+            batch, reports, failures = fetch_batch_reports(st.session_state.OPENAI_API_KEY, batch_info["id"])
+            if batch.status == "completed":
+                batch_info["reports"] = reports
+                batch_info["failures"] = failures
+                # Completed reports also serve later "Analyze" clicks on the same images
+                analysis_cache = st.session_state.setdefault("analysis_cache", {})
+                for image_hash, report in reports.items():
+                    analysis_cache[image_hash] = (report, [])
+                while len(analysis_cache) > MAX_CACHED_ANALYSES:
+                    analysis_cache.pop(next(iter(analysis_cache)))
+            else:
+                counts = batch.request_counts
+                st.info(
+                    f"Batch {batch.id} is {batch.status}"
+                    + (f" ({counts.completed}/{counts.total} done)." if counts else ".")
+                )
+        except Exception as e:
+            st.error(f"Batch status error: {e}")
+
+    names = batch_info["names"]
+    for custom_id, reason in batch_info.get("failures", []):
+        st.warning(f"No report for {names.get(custom_id, custom_id or 'an unknown image')}: {reason}")
+    if batch_info.get("reports"):
+        batch_tabs = st.tabs([names.get(image_hash, image_hash) for image_hash in batch_info["reports"]])
+        for tab, report in zip(batch_tabs, batch_info["reports"].values()):
+            with tab:
+                render_report(report)